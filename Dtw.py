@@ -4,6 +4,7 @@
 
 # Core Library modules
 import logging
+import threading
 
 logging.basicConfig(
     filename="classifier.log",
@@ -12,24 +13,83 @@ logging.basicConfig(
 )
 
 
+class Workspace:
+    """
+    Buffers for the dynamic programming which are reused for many
+    comparisons instead of allocating new containers for every pair.
+    They grow to the largest sequences seen so far.
+    A workspace must not be shared between threads, see get_workspace().
+    """
+
+    def __init__(self):
+        self.columns = 0  # the rows hold columns + 1 values
+        self.previous = []
+        self.current = []
+        self.matrix_size = 0
+        self.cost = []  # (len(seq1) + 1) x (len(seq2) + 1), row by row
+        self.path = []
+        # The PackedDrawing decoded last and its coordinates, see packed.py
+        self.decoded = (None, None)
+
+    def reserve_rows(self, columns):
+        if columns > self.columns:
+            self.columns = columns
+            self.previous = [0.0] * (columns + 1)
+            self.current = [0.0] * (columns + 1)
+
+    def reserve_matrix(self, rows, columns):
+        size = (rows + 1) * (columns + 1)
+        if size > self.matrix_size:
+            self.matrix_size = size
+            self.cost = [0.0] * size
+
+
+_local = threading.local()
+
+
+def get_workspace():
+    """Get the workspace of the current thread.
+
+    >>> get_workspace() is get_workspace()
+    True
+    """
+    workspace = getattr(_local, "workspace", None)
+    if workspace is None:
+        workspace = _local.workspace = Workspace()
+    return workspace
+
+
 class Dtw:
-    def __init__(self, seq1, seq2, distance_func=None):
+    def __init__(self, seq1, seq2, distance_func=None, workspace=None):
         """
         seq1, seq2 are two lists,
         distance_func is a function for calculating
         the local distance between two elements.
+        workspace is an optional Workspace. With a workspace, seq1 and seq2
+        are left untouched and the cost matrix as well as the list returned
+        by get_path() are the buffers of the workspace, so they are only
+        valid until the workspace is used for the next comparison.
         """
         self._seq1 = seq1
         self._seq2 = seq2
         self._distance_func = distance_func if distance_func else lambda: 0
-        self._map = {(-1, -1): 0.0}
-        self._distance_matrix = {}
-        self._path = []
+        self._workspace = workspace
+        if workspace is None:
+            self._map = {(-1, -1): 0.0}
+            self._distance_matrix = {}
+            self._path = []
+        # Statistics of the last calculation, read by the metrics code
+        self.cells_evaluated = 0
 
     def get_distance(self, i1, i2):
+        if self._workspace is not None:
+            # The workspace has no memo, callers compute every cell once
+            self.cells_evaluated += 1
+            return self._distance_func(self._seq1[i1], self._seq2[i2])
         ret = self._distance_matrix.get((i1, i2))
         if not ret:
             ret = self._distance_func(self._seq1[i1], self._seq2[i2])
+            self.cells_evaluated += 1
             self._distance_matrix[(i1, i2)] = ret
         return ret
 
@@ -38,6 +98,10 @@ class Dtw:
         Calculate the dtw distance between
         seq1[:i1 + 1] and seq2[:i2 + 1]
         """
+        if self._workspace is not None:
+            if i1 == -1 or i2 == -1:
+                return 0.0 if i1 == i2 else float("inf")
+            return self._calculate_full_workspace(i1 + 1, i2 + 1)
         if self._map.get((i1, i2)) is not None:
             return self._map[(i1, i2)]
 
@@ -63,6 +127,8 @@ class Dtw:
         Calculate the path mapping.
         Must be called after calculate()
         """
+        if self._workspace is not None:
+            return self._get_path_workspace()
         i1, i2 = (len(self._seq1) - 1, len(self._seq2) - 1)
         while (i1, i2) != (-1, -1):
             self._path.append((i1, i2))
@@ -75,7 +141,129 @@ class Dtw:
             i1, i2 = min_i1, min_i2
         return self._path
 
+    def _calculate_full_workspace(self, n, m):
+        """
+        Same as calculate_backward(n - 1, m - 1), but computed iteratively
+        in the cost matrix of the workspace.
+        """
+        A, B = self._seq1, self._seq2
+        self._workspace.reserve_matrix(n, len(B))
+        cost = self._workspace.cost
+        # The stride does not depend on m, so get_path() can read the matrix
+        stride = len(B) + 1
+        inf = float("inf")
+        cost[0] = 0.0
+        for j in range(1, m + 1):
+            cost[j] = inf
+        for i in range(1, n + 1):
+            row = i * stride
+            above = row - stride
+            cost[row] = inf
+            a = A[i - 1]
+            for j in range(1, m + 1):
+                cost[row + j] = self._distance_func(a, B[j - 1]) + min(
+                    cost[above + j], cost[row + j - 1], cost[above + j - 1]
+                )
+        self.cells_evaluated = n * m
+        return cost[n * stride + m]
+
+    def _get_path_workspace(self):
+        cost = self._workspace.cost
+        stride = len(self._seq2) + 1
+        path = self._workspace.path
+        del path[:]
+        i1, i2 = (len(self._seq1) - 1, len(self._seq2) - 1)
+        while (i1, i2) != (-1, -1):
+            path.append((i1, i2))
+            i1, i2 = min(
+                (i1 - 1, i2),
+                (i1, i2 - 1),
+                (i1 - 1, i2 - 1),
+                key=lambda x: cost[(x[0] + 1) * stride + x[1] + 1],
+            )
+        return path
+
+    def _calculate_simplified_workspace(self):
+        """
+        Same as the simplified calculation, but with indices into the
+        sequences instead of popping their elements.
+        """
+        A, B = self._seq1, self._seq2
+        f = self._distance_func
+        n, m = len(A), len(B)
+        d = 0
+        if n == 0 or m == 0:
+            logging.error("This should not happen (0)")
+            return 0
+        if n == 1:
+            for p in B:
+                d = d + f(A[0], p)
+            self.cells_evaluated = m
+            return d
+        if m == 1:
+            for p in A:
+                d = d + f(B[0], p)
+            self.cells_evaluated = n
+            return d
+        # a = A[i + 1], a2 = A[i], b = B[j + 1], b2 = B[j]
+        i, j = n - 2, m - 2
+        d = f(A[i + 1], B[j + 1])
+        cells = 1
+        while i > 0 and j > 0:
+            l = f(A[i], B[j + 1])
+            mid = f(A[i], B[j])
+            r = f(A[i + 1], B[j])
+            mu = min(l, mid, r)
+            d += mu
+            cells += 3
+            if l == mu:
+                i -= 1
+            elif r == mu:
+                j -= 1
+            else:
+                i -= 1
+                j -= 1
+        if i == 0:
+            for k in range(j):
+                d += f(A[0], B[k])
+            cells += j
+        else:
+            for k in range(i):
+                d += f(B[0], A[k])
+            cells += i
+        self.cells_evaluated = cells
+        return d
+
     def calculate(self, simplified=True):
+        """
+        Calculate the dtw distance of seq1 and seq2, greedily (simplified)
+        or with the full dynamic programming. get_path() needs the latter.
+        The results are the same with and without a workspace:
+
+        >>> f = lambda x, y: abs(x - y)
+        >>> a, b = [1, 2, 3, 5, 5], [1, 3, 4, 6]
+        >>> workspace = Workspace()
+        >>> Dtw(a[:], b[:], f).calculate(), Dtw(a, b, f, workspace).calculate()
+        (3, 3)
+        >>> full = Dtw(a[:], b[:], f)
+        >>> full.calculate(False), full.get_path()
+        (3.0, [(4, 3), (3, 2), (2, 1), (1, 1), (0, 0)])
+        >>> full = Dtw(a, b, f, workspace)
+        >>> full.calculate(False), full.get_path()
+        (3.0, [(4, 3), (3, 2), (2, 1), (1, 1), (0, 0)])
+        >>> (Dtw(a[:], b[:], f).calculate_backward(2, 1),
+        ...  Dtw(a, b, f, workspace).calculate_backward(2, 1))
+        (1.0, 1.0)
+
+        Only the calculation without a workspace consumes the sequences:
+
+        >>> a, b
+        ([1, 2, 3, 5, 5], [1, 3, 4, 6])
+        """
+        if self._workspace is not None:
+            if simplified:
+                return self._calculate_simplified_workspace()
+            return self._calculate_full_workspace(len(self._seq1), len(self._seq2))
         if simplified:
             A = self._seq1
             B = self._seq2
@@ -89,12 +277,15 @@ class Dtw:
                 a2 = A.pop()
                 for p in B:
                     d = d + self._distance_func(a2, p)
+                self.cells_evaluated = len(B)
                 return d
             if len(B) == 1:
                 b2 = B.pop()
                 for p in A:
                     d = d + self._distance_func(b2, p)
+                self.cells_evaluated = len(A)
                 return d
+            cells = 1
             a = A.pop()
             b = B.pop()
             d = self._distance_func(a, b)
@@ -106,6 +297,7 @@ class Dtw:
                 r = self._distance_func(a, b2)
                 mu = min(l, m, r)
                 d += mu
+                cells += 3
                 if l == mu:
                     a = a2
                     a2 = A.pop()
@@ -120,9 +312,18 @@ class Dtw:
             if len(A) == 0:
                 for p in B:
                     d += self._distance_func(a2, p)
+                cells += len(B)
             elif len(B) == 0:
                 for p in A:
                     d += self._distance_func(b2, p)
+                cells += len(A)
+            self.cells_evaluated = cells
             return d
         else:
             return self.calculate_backward(len(self._seq1) - 1, len(self._seq2) - 1)
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+"""Offline benchmarks for the DTW and classification paths.
+
+The benchmarks run on synthetic multi-stroke handwriting that is generated
+from a fixed seed, so they need no database and are reproducible. Results are
+written as JSON and can be compared against a stored baseline:
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --output new.json --baseline baseline.json
+"""
+
+# Core Library modules
+import argparse
+import datetime
+import json
+import math
+import platform
+import random
+import sys
+import time
+
+# First party modules
+from classification import (
+    classify,
+    distance,
+    douglas_peucker,
+    dtw,
+    pointLineList,
+    preprocess,
+    scale_and_center,
+    space_evenly,
+)
+from Dtw import Dtw, Workspace
+
+SIZES = {"small": 10, "medium": 50, "large": 150}
+SEED = 42
+
+
+def generate_stroke(rng, points, start=0):
+    """Generate a smooth random stroke with `points` points.
+
+    The stroke follows a random walk with momentum, which looks more like a
+    pen movement than independent random points.
+    """
+    x, y = rng.uniform(0, 300), rng.uniform(0, 300)
+    angle = rng.uniform(0, 2 * math.pi)
+    stroke = []
+    time_ = start
+    for _ in range(points):
+        stroke.append({"x": int(round(x)), "y": int(round(y)), "time": time_})
+        angle += rng.gauss(0, 0.4)
+        step = rng.uniform(2, 8)
+        x += step * math.cos(angle)
+        y += step * math.sin(angle)
+        time_ += rng.randint(7, 9)
+    return stroke
+
+
+def generate_drawing(rng, points, strokes=2):
+    """Generate a drawing with `strokes` strokes of `points` points each."""
+    drawing = []
+    time_ = 0
+    for _ in range(strokes):
+        stroke = generate_stroke(rng, points, time_)
+        drawing.append(stroke)
+        time_ = stroke[-1]["time"] + rng.randint(100, 300)
+    return drawing
+
+
+def distort(rng, drawing, noise=3):
+    """Get a slightly distorted copy of a drawing."""
+    return [
+        [
+            {
+                "x": p["x"] + int(rng.gauss(0, noise)),
+                "y": p["y"] + int(rng.gauss(0, noise)),
+                "time": p["time"],
+            }
+            for p in stroke
+        ]
+        for stroke in drawing
+    ]
+
+
+def generate_datasets(rng, formulas, per_formula, points):
+    """Generate raw datasets in the format classify() expects.
+
+    Every formula gets a prototype drawing with 1 to 3 strokes and
+    `per_formula` distorted copies of it.
+    """
+    datasets = []
+    for formula_id in range(1, formulas + 1):
+        prototype = generate_drawing(rng, points, rng.randint(1, 3))
+        for _ in range(per_formula):
+            datasets.append(
+                {
+                    "data": json.dumps(distort(rng, prototype)),
+                    "id": len(datasets) + 1,
+                    "formula_id": formula_id,
+                    "accepted_formula_id": formula_id,
+                    "formula_in_latex": "f%i" % formula_id,
+                }
+            )
+    return datasets
+
+
+def percentile(values, p):
+    """Get the p-th percentile of `values` (nearest-rank method).
+
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    >>> percentile([1, 2, 3, 4], 100)
+    4
+    """
+    values = sorted(values)
+    index = max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)
+    return values[index]
+
+
+def measure(function, make_args, repeat):
+    """Call `function(*make_args())` `repeat` times and summarize the times.
+
+    The arguments are created outside of the measured time, because some of
+    the measured functions consume their input.
+    """
+    function(*make_args())  # warm-up
+    times = []
+    for _ in range(repeat):
+        args = make_args()
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return {
+        "repeat": repeat,
+        "mean": sum(times) / len(times),
+        "min": min(times),
+        "p50": percentile(times, 50),
+        "p90": percentile(times, 90),
+        "p99": percentile(times, 99),
+    }
+
+
+def run_benchmarks(repeat=20, sizes=None):
+    """Run all benchmarks and return a dict mapping names to timings."""
+    if sizes is None:
+        sizes = SIZES
+    results = {}
+    try:
+        import scipy.interpolate  # noqa: F401
+
+        has_scipy = True
+    except ImportError:
+        has_scipy = False
+        sys.stderr.write("scipy is not installed, skipping space_evenly\n")
+
+    for size, points in sorted(sizes.items(), key=lambda item: item[1]):
+        rng = random.Random(SEED)
+        A = scale_and_center([generate_stroke(rng, points)])[0]
+        B = scale_and_center([generate_stroke(rng, points)])[0]
+        A2 = scale_and_center(generate_drawing(rng, points, 3))
+        B2 = scale_and_center(generate_drawing(rng, points, 3))
+        raw = json.dumps(generate_drawing(rng, points, 3))
+
+        workspace = Workspace()
+
+        def calculate(a, b, simplified, workspace=None):
+            return Dtw(a, b, lambda p, q: distance(p, q, True), workspace).calculate(
+                simplified
+            )
+
+        def dtw_workspace(a, b):
+            return dtw(a, b, workspace=workspace)
+
+        results["Dtw.calculate[greedy,%s]" % size] = measure(
+            calculate, lambda: (A[:], B[:], True), repeat
+        )
+        results["Dtw.calculate[full,%s]" % size] = measure(
+            calculate, lambda: (A[:], B[:], False), repeat
+        )
+        results["Dtw.calculate[full,workspace,%s]" % size] = measure(
+            calculate, lambda: (A, B, False, workspace), repeat
+        )
+        results["dtw[flat,%s]" % size] = measure(dtw, lambda: (A, B[:]), repeat)
+        results["dtw[flat,workspace,%s]" % size] = measure(
+            dtw_workspace, lambda: (A, B), repeat
+        )
+        results["dtw[strokes,%s]" % size] = measure(
+            dtw, lambda: (A2, [line[:] for line in B2]), repeat
+        )
+        results["dtw[strokes,workspace,%s]" % size] = measure(
+            dtw_workspace, lambda: (A2, B2), repeat
+        )
+        results["pointLineList[%s]" % size] = measure(
+            pointLineList, lambda: (raw,), repeat
+        )
+        results["scale_and_center[%s]" % size] = measure(
+            scale_and_center, lambda: (pointLineList(raw),), repeat
+        )
+        results["douglas_peucker[%s]" % size] = measure(
+            douglas_peucker, lambda: (pointLineList(raw), 3), repeat
+        )
+        if has_scipy:
+            results["space_evenly[%s]" % size] = measure(
+                space_evenly, lambda: (pointLineList(raw)[0], 100), repeat
+            )
+
+    # End-to-end classification against a template set of moderate size
+    rng = random.Random(SEED)
+    datasets = generate_datasets(rng, formulas=20, per_formula=10, points=30)
+    queries = [
+        preprocess(pointLineList(dataset["data"]), FLATTEN=False)
+        for dataset in rng.sample(datasets, 10)
+    ]
+    query = iter(queries * (repeat + 1))
+    timing = measure(
+        lambda A: classify(datasets, A, FLATTEN=False),
+        lambda: (next(query),),
+        repeat,
+    )
+    timing["throughput"] = 1.0 / timing["mean"]
+    timing["templates"] = len(datasets)
+    results["classify"] = timing
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Compare the median times of `results` with those of `baseline`.
+
+    Benchmarks which only exist on one side are listed after the table.
+
+    @return tuple (names of the benchmarks which are slower than the baseline
+            by more than `tolerance` (relative), names of the benchmarks of
+            the baseline which are missing in `results`)
+    """
+    regressions = []
+    print("%-35s %12s %12s %8s" % ("benchmark", "baseline", "current", "change"))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]["p50"]
+        new = results[name]["p50"]
+        change = (new - old) / old if old > 0 else 0.0
+        marker = ""
+        if change > tolerance:
+            regressions.append(name)
+            marker = " !"
+        print("%-35s %12.6f %12.6f %+7.1f%%%s" % (name, old, new, change * 100, marker))
+    missing = sorted(set(baseline) - set(results))
+    added = sorted(set(results) - set(baseline))
+    if missing:
+        print("Missing in this run: %s" % ", ".join(missing))
+    if added:
+        print("Not in the baseline: %s" % ", ".join(added))
+    return regressions, missing
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON file of an earlier run")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="relative slowdown of the median which counts as regression",
+    )
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    report = {
+        "date": str(datetime.datetime.now()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": run_benchmarks(args.repeat),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions, missing = compare(
+            report["results"], baseline["results"], args.tolerance
+        )
+        if regressions:
+            print("Regressions: %s" % ", ".join(regressions))
+        if missing:
+            print("Benchmarks of the baseline did not run: %s" % ", ".join(missing))
+        if regressions or missing:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,8 +3,13 @@
 # Core Library modules
 import json
 import logging
+import time
 from math import exp, sqrt
 
+# First party modules
+import metrics
+from packed import PackedDrawing, dtw_packed
+
 CLASSIFIER_NAME = "dtw-python"
 
 
@@ -153,10 +158,21 @@ def distance(p1, p2, squared=False):
         return sqrt(dx * dx + dy * dy)
 
 
-def dtw(A, B, simple=True, SQUARED=True):
+def squared_distance(p1, p2):
+    """ Same as distance(p1, p2, True), but without the extra argument, so it
+        can directly be used as distance function of Dtw.
+    """
+    dx = p1["x"] - p2["x"]
+    dy = p1["y"] - p2["y"]
+    return dx * dx + dy * dy
+
+
+def dtw(A, B, simple=True, SQUARED=True, workspace=None):
     """ Calculate the distance of A and B by greedy dynamic time warping.
-    @param  list A list of points
-    @param  list B list of points
+    @param  list A list of points (or PackedDrawing, see packed.py)
+    @param  list B list of points (or PackedDrawing, see packed.py)
+    @param  Workspace workspace buffers to reuse (see Dtw.get_workspace()).
+                      Without a workspace, the lines of B are consumed.
     @return float  Minimal distance you have to move points from A to get B
 
     >>> '%.2f' % dtw([{'x': 0, 'y': 0}, {'x': 1, 'y': 1}], \
@@ -172,38 +188,56 @@ def dtw(A, B, simple=True, SQUARED=True):
                       False)
     '25.63'
     """
+    return dtw_with_cells(A, B, simple, SQUARED, workspace)[0]
+
+
+def dtw_with_cells(A, B, simple=True, SQUARED=True, workspace=None):
+    """ Same as dtw(), but also get the number of evaluated DTW cells.
+        Callers which compare many pairs add them up and count them in the
+        metrics once, see classify().
+        @return tuple (distance, number of evaluated cells)
+    """
     global logging
+    if isinstance(A, PackedDrawing):
+        return dtw_packed(A, B, simple, SQUARED, workspace)
     if len(A) == 0:
         logging.warning("A was empty. B:")
         logging.warning(A)
         logging.warning("B:")
         # logging.warning(B)
         throw
-        return 0
+        return 0, 0
     if len(B) == 0:
         logging.warning("B was empty. A:")
         # logging.warning(A)
         logging.warning("B:")
         # logging.warning(B)
-        return 0
+        return 0, 0
 
     distanceSum = 0.0
+    cells = 0
     if isinstance(A[0], list):
         if len(A) != len(B):
-            return float("inf")
-        else:
-            from Dtw import Dtw
-
-            for lineA, lineB in zip(A, B):
-                a = Dtw(lineA[:], lineB, lambda a, b: distance(a, b, SQUARED))
-                distanceSum += a.calculate(simple)
+            return float("inf"), 0
+        pairs = zip(A, B)
     else:
-        from Dtw import Dtw
+        pairs = [(A, B)]
+
+    from Dtw import Dtw
 
-        a = Dtw(A[:], B, lambda a, b: distance(a, b, SQUARED))
+    if workspace is None:
+        distance_func = lambda a, b: distance(a, b, SQUARED)
+    else:
+        distance_func = squared_distance if SQUARED else distance
+    for lineA, lineB in pairs:
+        if workspace is None:
+            # Without a workspace, Dtw consumes the sequences
+            lineA = lineA[:]
+        a = Dtw(lineA, lineB, distance_func, workspace)
         distanceSum += a.calculate(simple)
+        cells += a.cells_evaluated
 
-    return distanceSum
+    return distanceSum, cells
 
 
 def LotrechterAbstand(p1, p2, p3):
@@ -251,7 +285,7 @@ def DouglasPeucker(PointList, epsilon):
     # Finde den Punkt mit dem größten Abstand
     dmax = 0
     index = 0
-    for i in range(1, len(Pointlist)):
+    for i in range(1, len(PointList)):
         d = LotrechterAbstand(PointList[0], PointList[-1], PointList[i])
         if d > dmax:
             index = i
@@ -312,6 +346,26 @@ def get_dimensions(pointlist):
     return {"width": a["maxx"] - a["minx"], "height": a["maxy"] - a["miny"]}
 
 
+def preprocess(
+    pointlist, EPSILON=0, CENTER=False, FLATTEN=True, SPACE_EVENLY=False, POINTS=100
+):
+    """ Apply all preprocessing steps to a drawing.
+    @param  list pointlist list of lines as returned by pointLineList()
+    @return list           list of lines or list of points (if FLATTEN)
+    """
+    if EPSILON > 0:
+        pointlist = douglas_peucker(pointlist, EPSILON)
+
+    if SPACE_EVENLY:
+        pointlist = [space_evenly(line, POINTS) for line in pointlist]
+
+    pointlist = scale_and_center(pointlist, CENTER)
+
+    if FLATTEN:
+        pointlist = list_of_pointlists2pointlist(pointlist)
+    return pointlist
+
+
 def get_probability_from_distance(results):
     """ Get a list of results with dtw and formula id and return a dict mapping
         formula-ids to probabilities.
@@ -357,37 +411,60 @@ def classify(
     @return list     List of possible classifications, ordered DESC by
                        likelines
     """
+    from Dtw import get_workspace
+
+    workspace = get_workspace()
+    # Time per stage, summed over all templates of this call
+    stage_time = {"parse_templates": 0.0, "preprocess_templates": 0.0, "dtw": 0.0}
+    cells = 0
     results = []
     for key, dataset in enumerate(datasets):
-        B = dataset["data"]
-        if EPSILON > 0:
-            B = douglas_peucker(pointLineList(B), EPSILON)
-        else:
-            B = pointLineList(B)
-
-        if SPACE_EVENLY:
-            Bnew = []
-            for line in B:
-                Bnew.append(space_evenly(line, POINTS))
-            B = Bnew
+        start = time.perf_counter()
+        B = pointLineList(dataset["data"])
+        parsed = time.perf_counter()
+        stage_time["parse_templates"] += parsed - start
 
-        B = scale_and_center(B)
-
-        if FLATTEN:
-            B = list_of_pointlists2pointlist(B)
+        B = preprocess(B, EPSILON, False, FLATTEN, SPACE_EVENLY, POINTS)
+        preprocessed = time.perf_counter()
+        stage_time["preprocess_templates"] += preprocessed - parsed
 
+        distance_, evaluated = dtw_with_cells(A, B, workspace=workspace)
+        cells += evaluated
         results.append(
             {
-                "dtw": dtw(A, B),
+                "dtw": distance_,
                 "latex": dataset["accepted_formula_id"],
                 "id": dataset["id"],
                 "latex": dataset["formula_in_latex"],
                 "formula_id": dataset["formula_id"],
             }
         )
-
+        stage_time["dtw"] += time.perf_counter() - preprocessed
+
+    for stage, seconds in stage_time.items():
+        metrics.observe(stage, seconds)
+    metrics.inc("dtw_classifications_total")
+    metrics.inc("dtw_templates_compared_total", len(results))
+    metrics.inc("dtw_cells_evaluated_total", cells)
+    # dtw() returns infinity for templates with a different number of strokes
+    mismatched = sum(1 for var in results if var["dtw"] == float("inf"))
+    too_far = sum(1 for var in results if THRESHOLD <= var["dtw"] < float("inf"))
+    if mismatched:
+        metrics.inc("dtw_templates_pruned_total", mismatched, reason="stroke_count")
+    if too_far:
+        metrics.inc("dtw_templates_pruned_total", too_far, reason="threshold")
+
+    with metrics.timed("ranking"):
+        return rank(results, THRESHOLD)
+
+
+def rank(results, THRESHOLD=100):
+    """ Turn the DTW distances of all compared templates into a list of
+        the (at most) 10 most probable formulas. The pruned templates are
+        counted by classify(), so rank() can also be used for evaluations.
+    """
     results = sorted(results, key=lambda k: k["dtw"])
-    results = filter(lambda var: var["dtw"] < THRESHOLD, results)
+    results = [var for var in results if var["dtw"] < THRESHOLD]
     # get only best match for each single symbol
     results2 = {}
     for row in results:
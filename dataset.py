@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""Load the raw drawings of all formulas for self-testing.
+
+All drawings are fetched together with their formula in a single query. The
+result can be cached in a local JSON file, and the same JSON format (or a
+SQLite copy of the two tables) can be used to run without the MySQL server.
+"""
+
+# Core Library modules
+import json
+import logging
+import os
+import sqlite3
+
+SQL = (
+    "SELECT `wm_raw_draw_data`.`id` AS `id`, `data`, "
+    "`accepted_formula_id` AS `formula_id`, `formula_in_latex` "
+    "FROM `wm_raw_draw_data` "
+    "JOIN `wm_formula` ON `wm_formula`.`id` = `accepted_formula_id` "
+    "ORDER BY `accepted_formula_id`, `wm_raw_draw_data`.`id`"
+)
+FIELDS = ("id", "data", "formula_id", "formula_in_latex")
+
+
+def connect():
+    """Connect to the MySQL database configured in dbconfig.py."""
+    # Third party modules
+    import MySQLdb
+    from dbconfig import mysql
+
+    logging.info("start establishing connection")
+    connection = MySQLdb.connect(
+        host=mysql["host"], user=mysql["user"], passwd=mysql["passwd"], db=mysql["db"]
+    )
+    logging.info("end establishing connection")
+    return connection
+
+
+def load_from_mysql(connection, batch_size=1000):
+    """ Fetch all raw drawings with a server-side cursor.
+        @return list of dicts with the keys FIELDS
+    """
+    # Third party modules
+    import MySQLdb.cursors
+
+    cursor = connection.cursor(MySQLdb.cursors.SSDictCursor)
+    try:
+        cursor.execute(SQL)
+        rows = []
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                break
+            rows += [{key: row[key] for key in FIELDS} for row in batch]
+    finally:
+        cursor.close()
+    return rows
+
+
+def load_from_sqlite(path):
+    """ Fetch all raw drawings from a SQLite copy of the tables
+        `wm_raw_draw_data` and `wm_formula`.
+    """
+    connection = sqlite3.connect(path)
+    connection.row_factory = sqlite3.Row
+    try:
+        return [{key: row[key] for key in FIELDS} for row in connection.execute(SQL)]
+    finally:
+        connection.close()
+
+
+def load_from_file(path):
+    """Load raw drawings which were stored with save_to_file()."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_to_file(rows, path):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(rows, f)
+    os.replace(tmp, path)
+
+
+def load(path=None, cache_file=None, connect=connect):
+    """ Get all raw drawings.
+
+    If `path` is given, the drawings are read from this SQLite database (file
+    ending .sqlite/.db) or JSON file. Otherwise they come from the cache file
+    if it exists, or from the MySQL database; in the latter case the cache
+    file is written. `connect` is only called when the database is needed.
+    """
+    if path is not None:
+        if os.path.splitext(path)[1] in (".sqlite", ".sqlite3", ".db"):
+            return load_from_sqlite(path)
+        return load_from_file(path)
+    if cache_file is not None and os.path.isfile(cache_file):
+        logging.info("Load raw datasets from cache '%s'", cache_file)
+        return load_from_file(cache_file)
+    connection = connect()
+    try:
+        rows = load_from_mysql(connection)
+    finally:
+        connection.close()
+    if cache_file is not None:
+        save_to_file(rows, cache_file)
+    return rows
+
+
+def make_folds(rows, K_FOLD=10, MIN_OCCURENCES=10):
+    """ Distribute the drawings of all formulas with at least MIN_OCCURENCES
+        drawings round-robin over K_FOLD folds.
+        @param  list rows drawings ordered by formula, as returned by load()
+        @return tuple (folds, list of (formula_in_latex, drawings) tuples)
+
+    >>> rows = [{'id': i, 'data': '[]', 'formula_id': i % 2, \
+                 'formula_in_latex': 'ab'[i % 2]} for i in range(5)]
+    >>> cv, symbols = make_folds(sorted(rows, key=lambda r: r['formula_id']), \
+                                 2, 3)
+    >>> [[item['id'] for item in fold] for fold in cv]
+    [[0, 4], [2]]
+    >>> symbols
+    [('a', 3)]
+    """
+    by_formula = {}
+    order = []
+    for row in rows:
+        if row["formula_id"] not in by_formula:
+            by_formula[row["formula_id"]] = []
+            order.append(row["formula_id"])
+        by_formula[row["formula_id"]].append(row)
+
+    cv = [[] for _ in range(K_FOLD)]
+    symbols = []
+    for formula_id in order:
+        raw_datasets = by_formula[formula_id]
+        if len(raw_datasets) < MIN_OCCURENCES:
+            continue
+        symbols.append((raw_datasets[0]["formula_in_latex"], len(raw_datasets)))
+        for i, raw_data in enumerate(raw_datasets):
+            cv[i % K_FOLD].append(
+                {
+                    "data": raw_data["data"],
+                    "id": raw_data["id"],
+                    "formula_id": formula_id,
+                    "accepted_formula_id": formula_id,
+                    "formula_in_latex": raw_data["formula_in_latex"],
+                }
+            )
+    return cv, symbols
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+"""Pairwise DTW distances of a whole data set.
+
+Cross-validation only needs the distance of every test drawing to every
+drawing of the other folds. Computing all of those distances once and deriving
+every fold, every top-1/top-10 metric and every THRESHOLD from the resulting
+matrix is much cheaper than calling classify() for each test drawing, which
+parses, preprocesses and compares the same pairs over and over again.
+"""
+
+# Core Library modules
+import hashlib
+import logging
+import multiprocessing
+import os
+import pickle
+import sys
+from array import array
+
+# First party modules
+import metrics
+from classification import dtw_with_cells, rank
+from Dtw import get_workspace
+from packed import PackedDrawing
+
+_queries = None
+_templates = None
+_options = None
+
+
+def copy_drawing(drawing):
+    """Copy the lines of a drawing. Several preprocessing steps and dtw()
+    without a workspace modify their input in place.
+    """
+    if isinstance(drawing, PackedDrawing):
+        # Packed drawings are read-only for dtw()
+        return drawing
+    if len(drawing) > 0 and isinstance(drawing[0], list):
+        return [line[:] for line in drawing]
+    return drawing[:]
+
+
+def _mirrored(templates, options):
+    """Whether only the upper triangle of the matrix is computed. Only the
+    full DTW is symmetric; the greedy DTW breaks ties by the order of its
+    arguments, and repeated points (pen pauses, integer tablet coordinates)
+    make ties common.
+    """
+    simple = options[0]
+    return templates is None and not simple
+
+
+def _init_worker(queries, templates, options):
+    global _queries, _templates, _options
+    _queries = queries
+    _templates = templates
+    _options = options
+
+
+def _compute_rows(rows):
+    """Compute the rows `rows` (a (start, end) tuple) of the matrix.
+
+    If the matrix is mirrored (see _mirrored()), only the entries right of
+    the diagonal are computed. The number of evaluated DTW cells and of
+    compared pairs is returned for the parent to count, as the metrics of a
+    worker process are lost.
+    """
+    mirrored = _mirrored(_templates, _options)
+    templates = _queries if _templates is None else _templates
+    workspace = get_workspace()
+    cells = 0
+    compared = 0
+    result = []
+    for i in range(*rows):
+        A = _queries[i]
+        first = i + 1 if mirrored else 0
+        row = array("d")
+        for j in range(first, len(templates)):
+            if j == i:
+                # The distance of a drawing to itself is never used
+                row.append(0.0)
+            else:
+                d, evaluated = dtw_with_cells(
+                    A, templates[j], *_options, workspace=workspace
+                )
+                row.append(d)
+                cells += evaluated
+                compared += 1
+        result.append(row)
+    return rows, result, cells, compared
+
+
+def _checkpoint_key(queries, templates, options):
+    key = hashlib.sha1()
+    # The layout of the stored rows depends on whether they are mirrored
+    mirrored = _mirrored(templates, options)
+    key.update(pickle.dumps((queries, templates, options, mirrored), protocol=2))
+    return key.hexdigest()
+
+
+def _write_checkpoint(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def compute_distance_matrix(
+    queries,
+    templates=None,
+    simple=True,
+    SQUARED=True,
+    processes=None,
+    checkpoint_dir=None,
+    chunk_size=32,
+):
+    """Compute dtw(queries[i], templates[j]) for all i and j.
+
+    If `templates` is None, the queries are compared with each other. With
+    the full DTW (simple=False), which is symmetric, every pair is only
+    computed once and mirrored. The greedy DTW is not symmetric when there
+    are ties, so both directions are computed, like classify() would.
+
+    The work is spread over `processes` worker processes (default: one per
+    core). If `checkpoint_dir` is given, every finished chunk of `chunk_size`
+    rows is stored there and an interrupted run continues where it stopped.
+
+    @param  list queries   preprocessed drawings (see preprocess())
+    @param  list templates preprocessed drawings or None
+    @return list           list of rows, each an array of floats
+    """
+    options = (simple, SQUARED)
+    mirrored = _mirrored(templates, options)
+    n = len(queries)
+    m = n if templates is None else len(templates)
+    matrix = [array("d", [0.0]) * m for _ in range(n)]
+    chunks = [(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)]
+
+    done = {}
+    if checkpoint_dir is not None:
+        checkpoint_dir = os.path.join(
+            checkpoint_dir, _checkpoint_key(queries, templates, options)
+        )
+        if not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        for rows in chunks:
+            path = os.path.join(checkpoint_dir, "rows-%i-%i.pickle" % rows)
+            if os.path.isfile(path):
+                with open(path, "rb") as f:
+                    done[rows] = pickle.load(f)
+        logging.info("Loaded %i of %i chunks from checkpoints", len(done), len(chunks))
+
+    todo = [rows for rows in chunks if rows not in done]
+    if processes == 1:
+        _init_worker(queries, templates, options)
+        computed = map(_compute_rows, todo)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(
+            processes, initializer=_init_worker, initargs=(queries, templates, options)
+        )
+        computed = pool.imap_unordered(_compute_rows, todo)
+
+    try:
+        for rows, result, cells, compared in computed:
+            metrics.inc("dtw_cells_evaluated_total", cells)
+            metrics.inc("dtw_templates_compared_total", compared)
+            if checkpoint_dir is not None:
+                path = os.path.join(checkpoint_dir, "rows-%i-%i.pickle" % rows)
+                _write_checkpoint(path, result)
+            done[rows] = result
+            print("|", end="")
+            sys.stdout.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    for (start, end), result in done.items():
+        for i, row in zip(range(start, end), result):
+            if mirrored:
+                matrix[i][i + 1 :] = row
+                for offset, value in enumerate(row):
+                    matrix[i + 1 + offset][i] = value
+            else:
+                matrix[i][:] = row
+    return matrix
+
+
+def crossvalidate(matrix, cv, THRESHOLD=100):
+    """Evaluate a k-fold cross-validation with the precomputed distances.
+
+    @param  list matrix distances of all items of `cv`, in the order of
+                        `[item for fold in cv for item in fold]`
+    @param  list cv     list of folds, each a list of items with a
+                        'formula_id'
+    @return list        per fold a dict with the number of correct/wrong
+                        top-1 ('correct', 'wrong') and top-10 ('c10', 'w10')
+                        classifications and the resulting accuracies
+                        ('accuracy', 'a10')
+    """
+    items = []
+    fold_of = []
+    for fold, testset in enumerate(cv):
+        items += testset
+        fold_of += [fold] * len(testset)
+
+    classification_accuracy = []
+    for fold in range(len(cv)):
+        classification_accuracy.append({"correct": 0, "wrong": 0, "c10": 0, "w10": 0})
+        for i, testdata in enumerate(items):
+            if fold_of[i] != fold:
+                continue
+            # Only the best template of each formula can make it into the
+            # ranking, so reduce the row to those before ranking.
+            best = {}
+            row = matrix[i]
+            for j, template in enumerate(items):
+                if fold_of[j] == fold:
+                    continue
+                formula_id = template["formula_id"]
+                if formula_id not in best or row[j] < best[formula_id]:
+                    best[formula_id] = row[j]
+            results = rank(
+                [{"formula_id": key, "dtw": value} for key, value in best.items()],
+                THRESHOLD,
+            )
+
+            answer_id = results[0]["formula_id"] if results else 0
+            if answer_id == testdata["formula_id"]:
+                classification_accuracy[fold]["correct"] += 1
+            else:
+                classification_accuracy[fold]["wrong"] += 1
+            if testdata["formula_id"] in [r["formula_id"] for r in results]:
+                classification_accuracy[fold]["c10"] += 1
+            else:
+                classification_accuracy[fold]["w10"] += 1
+
+        accuracy = classification_accuracy[fold]
+        accuracy["accuracy"] = float(accuracy["correct"]) / max(
+            accuracy["correct"] + accuracy["wrong"], 1
+        )
+        accuracy["a10"] = float(accuracy["c10"]) / max(
+            accuracy["c10"] + accuracy["w10"], 1
+        )
+    return classification_accuracy
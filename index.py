@@ -7,9 +7,10 @@ import logging
 import MySQLdb
 import MySQLdb.cursors
 from dbconfig import mysql
-from flask import Flask, request
+from flask import Flask, Response, request
 
 # First party modules
+import metrics
 from classification import *
 
 CLASSIFIER_NAME = "DTW-Python"
@@ -20,11 +21,12 @@ app = Flask(__name__)
 def classifyD(raw_data_id, raw_draw_data, epsilon):
     global cursor
 
-    if epsilon > 0:
-        result_path = apply_douglas_peucker(pointLineList(raw_draw_data), epsilon)
-    else:
+    with metrics.timed("parse_query"):
         result_path = pointLineList(raw_draw_data)
-    A = scale_and_center(list_of_pointlists2pointlist(result_path))
+    with metrics.timed("preprocess_query"):
+        if epsilon > 0:
+            result_path = apply_douglas_peucker(result_path, epsilon)
+        A = scale_and_center(list_of_pointlists2pointlist(result_path))
 
     # Get the first 4000 known formulas
     sql = (
@@ -34,8 +36,9 @@ def classifyD(raw_data_id, raw_draw_data, epsilon):
         "JOIN  `wm_formula` ON  `wm_formula`.`id` =  `accepted_formula_id` "
         "LIMIT 4000"
     )
-    cursor.execute(sql)
-    datasets = cursor.fetchall()
+    with metrics.timed("candidates"):
+        cursor.execute(sql)
+        datasets = cursor.fetchall()
     print(datasets)
 
     results = classify(datasets, A)
@@ -54,6 +57,11 @@ def index():
     return "No action given"
 
 
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     logging.basicConfig(
         filename="classifier.log",
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+"""In-process metrics for the classification path.
+
+The numbers are collected per process and can be rendered in the Prometheus
+text exposition format (served by the `/metrics` route of index.py) or as a
+short human readable summary (printed by selftest.py).
+"""
+
+# Core Library modules
+import threading
+import time
+from contextlib import contextmanager
+
+# The query drawing is parsed and preprocessed once per request, the templates
+# once per classify() call; the latter observations hold the time summed over
+# all templates, as do "dtw" and "ranking".
+STAGES = (
+    "parse_query",
+    "preprocess_query",
+    "candidates",
+    "parse_templates",
+    "preprocess_templates",
+    "dtw",
+    "ranking",
+)
+BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    float("inf"),
+)
+
+HELP = {
+    "dtw_stage_seconds": "Time spent in a stage of the classification path.",
+    "dtw_cells_evaluated_total": "Local distances evaluated by the DTW kernel.",
+    "dtw_templates_compared_total": "Templates compared against a drawing.",
+    "dtw_templates_pruned_total": "Templates dropped before the ranking.",
+    "dtw_cache_requests_total": "Lookups of the stage caches of sweep.py.",
+    "dtw_classifications_total": "Calls of classify().",
+}
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+
+
+def observe(stage, seconds):
+    """Record that `stage` took `seconds`."""
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+            _histograms[stage] = histogram
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+
+def inc(name, value=1, **labels):
+    """Increase the counter `name` with the given labels by `value`.
+
+    >>> reset()
+    >>> inc("dtw_cells_evaluated_total", 3)
+    >>> inc("dtw_cells_evaluated_total")
+    >>> get("dtw_cells_evaluated_total")
+    4
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def get(name, **labels):
+    """Get the current value of a counter."""
+    return _counters.get((name, tuple(sorted(labels.items()))), 0)
+
+
+def record_cache(cache, hit):
+    """Count a single lookup of `cache`."""
+    inc("dtw_cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+
+@contextmanager
+def timed(stage):
+    """Measure the time the body of the with-statement takes as `stage`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def reset():
+    """Forget everything that was recorded so far."""
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, value) for key, value in labels)
+
+
+def _format_float(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def render_prometheus():
+    """Render all metrics in the Prometheus text exposition format.
+
+    >>> reset()
+    >>> inc("dtw_classifications_total")
+    >>> print(render_prometheus())
+    # HELP dtw_classifications_total Calls of classify().
+    # TYPE dtw_classifications_total counter
+    dtw_classifications_total 1
+    <BLANKLINE>
+    """
+    lines = []
+    with _lock:
+        if _histograms:
+            lines.append("# HELP dtw_stage_seconds %s" % HELP["dtw_stage_seconds"])
+            lines.append("# TYPE dtw_stage_seconds histogram")
+        for stage in sorted(_histograms):
+            histogram = _histograms[stage]
+            for bound, count in zip(BUCKETS, histogram["buckets"]):
+                lines.append(
+                    'dtw_stage_seconds_bucket{stage="%s",le="%s"} %i'
+                    % (stage, _format_float(bound), count)
+                )
+            lines.append(
+                'dtw_stage_seconds_sum{stage="%s"} %s'
+                % (stage, _format_float(histogram["sum"]))
+            )
+            lines.append(
+                'dtw_stage_seconds_count{stage="%s"} %i' % (stage, histogram["count"])
+            )
+        names = sorted({name for name, _ in _counters})
+        for name in names:
+            lines.append("# HELP %s %s" % (name, HELP.get(name, name)))
+            lines.append("# TYPE %s counter" % name)
+            for key in sorted(k for k in _counters if k[0] == name):
+                lines.append("%s%s %s" % (name, _format_labels(key[1]), _counters[key]))
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    """Get the collected metrics as a list of human readable lines."""
+    lines = []
+    with _lock:
+        for stage in STAGES + tuple(sorted(set(_histograms) - set(STAGES))):
+            histogram = _histograms.get(stage)
+            if histogram is None or histogram["count"] == 0:
+                continue
+            lines.append(
+                "Stage %-20s: %8.5f seconds total, %8.5f seconds average (%i calls)"
+                % (
+                    stage,
+                    histogram["sum"],
+                    histogram["sum"] / histogram["count"],
+                    histogram["count"],
+                )
+            )
+        counters = dict(_counters)
+    cells = counters.get(("dtw_cells_evaluated_total", ()), 0)
+    compared = counters.get(("dtw_templates_compared_total", ()), 0)
+    lines.append("DTW cells evaluated: %i" % cells)
+    lines.append("Templates compared: %i" % compared)
+    for (name, labels), value in sorted(counters.items()):
+        if name == "dtw_templates_pruned_total":
+            lines.append("Templates pruned (%s): %i" % (dict(labels)["reason"], value))
+    caches = sorted(
+        {
+            dict(labels)["cache"]
+            for name, labels in counters
+            if name == "dtw_cache_requests_total"
+        }
+    )
+    for cache in caches:
+        hits = counters.get(
+            ("dtw_cache_requests_total", (("cache", cache), ("result", "hit"))), 0
+        )
+        misses = counters.get(
+            ("dtw_cache_requests_total", (("cache", cache), ("result", "miss"))), 0
+        )
+        lines.append(
+            "Cache %s: %i hits, %i misses (hit rate %0.5f)"
+            % (cache, hits, misses, float(hits) / max(hits + misses, 1))
+        )
+    return lines
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+"""Compact storage of preprocessed drawings.
+
+After scale_and_center() every point is a dict of two floats, which costs
+well over 200 bytes per point. A PackedDrawing stores the coordinates of all
+points of a drawing interleaved (x0, y0, x1, y1, ...) in one array, either as
+float32 (typecode 'f', 8 bytes per point) or as int16 fixed-point numbers
+(typecode 'h', 4 bytes per point, value = q * step). The step is 1 / SCALE for
+drawings in the unit square and grows with the largest absolute coordinate M
+otherwise (step = M / SCALE), for example for drawings which were centered by
+scale_and_center().
+
+Error bound
+-----------
+Every stored coordinate differs from the float64 value by at most
+
+    e = 2**(k - 25)   (float32, where 2**(k - 1) <= M < 2**k)
+    e = step / 2      (int16)
+
+which is 2**-25 and 0.5 / SCALE = 1.53e-5 in the unit square. Let e be the
+mean of this error of the two drawings and D the largest difference of two of
+their coordinates on the same axis (D = 1 in the unit square). The local
+distance of two points then differs by at most
+
+    8 * e * D + 8 * e**2   (squared euclidean distance, the default of dtw())
+    2 * sqrt(2) * e        (euclidean distance)
+
+and a DTW distance, which is a sum over a warping path of at most n + m - 1
+cells, by at most (n + m - 1) times that value (summed over the strokes).
+error_bound() computes this. The bound always holds for the full DTW, as the
+minimum over all paths cannot move further than the largest change of a
+single path. The greedy DTW follows the same path as with float64 unless two
+of its candidate steps are closer than twice the local bound; only then it may
+take another path and the bound does not apply.
+"""
+
+# Core Library modules
+from array import array
+from math import frexp, ldexp, sqrt
+
+SCALE = 32767
+
+
+class PackedDrawing:
+    """The points of a drawing as one array of coordinates.
+
+    `strokes` is None for a flat list of points. Otherwise it holds the index
+    of the first point of every stroke and the number of points at the end.
+    A coordinate is `coords[k] * step`.
+    """
+
+    __slots__ = ("typecode", "coords", "strokes", "step")
+
+    def __init__(self, typecode, coords, strokes=None, step=1.0):
+        self.typecode = typecode
+        self.coords = coords
+        self.strokes = strokes
+        self.step = step
+
+    def __len__(self):
+        if self.strokes is None:
+            return len(self.coords) // 2
+        return len(self.strokes) - 1
+
+    def points(self, stroke=None):
+        """Get the x and y coordinates of a stroke (or all points) as floats."""
+        start, end = 0, len(self.coords) // 2
+        if stroke is not None:
+            start, end = self.strokes[stroke], self.strokes[stroke + 1]
+        xs = self.coords[2 * start : 2 * end : 2].tolist()
+        ys = self.coords[2 * start + 1 : 2 * end : 2].tolist()
+        if self.step != 1.0:
+            xs = [x * self.step for x in xs]
+            ys = [y * self.step for y in ys]
+        return xs, ys
+
+
+def _encode(typecode, values):
+    """@return tuple (array of the encoded values, step)"""
+    if typecode == "f":
+        return array("f", values), 1.0
+    if typecode == "h":
+        step = max([1.0] + [abs(value) for value in values]) / SCALE
+        return array("h", [int(round(value / step)) for value in values]), step
+    raise ValueError("Unknown typecode '%s', use 'f' or 'h'" % typecode)
+
+
+def pack(drawing, typecode="f"):
+    """ Pack a preprocessed drawing (a list of points or a list of lines).
+
+    >>> packed = pack([[{'x': 0.0, 'y': 0.5}], [{'x': 1.0, 'y': 0.25}]], 'h')
+    >>> len(packed), packed.coords.tolist(), packed.strokes.tolist()
+    (2, [0, 16384, 32767, 8192], [0, 1, 2])
+    >>> unpack(pack([{'x': 0.5, 'y': 0.25}]))
+    [{'x': 0.5, 'y': 0.25}]
+
+    Centered drawings can leave the unit square, the step grows with them:
+
+    >>> from classification import dtw, scale_and_center
+    >>> centered = scale_and_center([[{'x': 0, 'y': 0}, {'x': 100, 'y': 10}]],
+    ...                             True)
+    >>> centered
+    [[{'x': 0.0, 'y': -4.5}, {'x': 1.0, 'y': -4.4}]]
+    >>> packed = pack(centered, 'h')
+    >>> packed.coords.tolist(), packed.step == 4.5 / SCALE
+    ([0, -32767, 7282, -32039], True)
+    >>> other = scale_and_center([[{'x': 0, 'y': 0}, {'x': 100, 'y': 30}]], True)
+    >>> packed_other = pack(other, 'h')
+    >>> exact = dtw(centered, [line[:] for line in other], False)
+    >>> abs(dtw(packed, packed_other, False) - exact) <= error_bound(
+    ...     packed, packed_other)
+    True
+    """
+    if len(drawing) > 0 and isinstance(drawing[0], list):
+        strokes = array("L", [0])
+        points = []
+        for line in drawing:
+            points += line
+            strokes.append(len(points))
+    else:
+        strokes = None
+        points = drawing
+    values = []
+    for p in points:
+        values.append(p["x"])
+        values.append(p["y"])
+    coords, step = _encode(typecode, values)
+    return PackedDrawing(typecode, coords, strokes, step)
+
+
+def unpack(packed):
+    """Get the drawing back as list of points or list of lines."""
+    if packed.strokes is None:
+        xs, ys = packed.points()
+        return [{"x": x, "y": y} for x, y in zip(xs, ys)]
+    drawing = []
+    for stroke in range(len(packed)):
+        xs, ys = packed.points(stroke)
+        drawing.append([{"x": x, "y": y} for x, y in zip(xs, ys)])
+    return drawing
+
+
+def _greedy(ax, ay, B, b, m, squared, workspace=None):
+    """ The greedy DTW of Dtw.calculate(simplified=True) on the points with
+        the coordinates ax, ay and the m points of B starting at coordinate
+        index b. It walks from the last points to the first ones in the same
+        way and needs no workspace. Every point of B is read once, when the
+        walk reaches it.
+        @return tuple (distance, number of evaluated cells)
+    """
+    bc, step = B.coords, B.step
+
+    def point(j):
+        j = b + 2 * j
+        return bc[j] * step, bc[j + 1] * step
+
+    def dist(i, x, y):
+        dx = ax[i] - x
+        dy = ay[i] - y
+        if squared:
+            return dx * dx + dy * dy
+        return sqrt(dx * dx + dy * dy)
+
+    n = len(ax)
+    if n == 0 or m == 0:
+        return 0, 0
+    # The costs are added one by one in the order of Dtw.calculate(), so the
+    # rounding is the same
+    d = 0
+    if n == 1:
+        for j in range(m):
+            d += dist(0, *point(j))
+        return d, m
+    if m == 1:
+        x, y = point(0)
+        for i in range(n):
+            d += dist(i, x, y)
+        return d, n
+    # a = A[i + 1], a2 = A[i], b = B[j + 1] = (x1, y1), b2 = B[j] = (x0, y0)
+    i, j = n - 2, m - 2
+    x1, y1 = point(j + 1)
+    x0, y0 = point(j)
+    d = dist(i + 1, x1, y1)
+    cells = 1
+    while i > 0 and j > 0:
+        l = dist(i, x1, y1)
+        mid = dist(i, x0, y0)
+        r = dist(i + 1, x0, y0)
+        mu = min(l, mid, r)
+        d += mu
+        cells += 3
+        if l == mu:
+            i -= 1
+            continue
+        if r == mu:
+            j -= 1
+        else:
+            i -= 1
+            j -= 1
+        x1, y1 = x0, y0
+        x0, y0 = point(j)
+    if i == 0:
+        for k in range(j):
+            d += dist(0, *point(k))
+        cells += j
+    else:
+        for k in range(i):
+            d += dist(k, x0, y0)
+        cells += i
+    return d, cells
+
+
+def _full(ax, ay, B, b, m, squared, workspace=None):
+    """ The full DTW of Dtw.calculate(simplified=False) on the same points as
+        _greedy(). The cost matrix is computed column by column, so every
+        point of B is read only once; this gives exactly the same distance.
+        The rows of the workspace are used if one is given.
+        @return tuple (distance, number of evaluated cells)
+    """
+    bc, step = B.coords, B.step
+    n = len(ax)
+    inf = float("inf")
+    if workspace is None:
+        previous, current = [0.0] * (n + 1), [0.0] * (n + 1)
+    else:
+        workspace.reserve_rows(n)
+        previous, current = workspace.previous, workspace.current
+    previous[0] = 0.0
+    for i in range(1, n + 1):
+        previous[i] = inf
+    for j in range(b, b + 2 * m, 2):
+        current[0] = inf
+        x, y = bc[j] * step, bc[j + 1] * step
+        for i in range(n):
+            dx = ax[i] - x
+            dy = ay[i] - y
+            cost = dx * dx + dy * dy
+            if not squared:
+                cost = sqrt(cost)
+            current[i + 1] = cost + min(previous[i], previous[i + 1], current[i])
+        previous, current = current, previous
+    return previous[n], n * m
+
+
+def _decode(A, workspace=None):
+    """ Get the x and y coordinates of every stroke of A (or of all points).
+        The workspace keeps the result for the next call with the same A, so a
+        drawing which is compared with many others is only decoded once.
+    """
+    if workspace is not None and workspace.decoded[0] is A:
+        return workspace.decoded[1]
+    if A.strokes is None:
+        coordinates = [A.points()]
+    else:
+        coordinates = [A.points(stroke) for stroke in range(len(A))]
+    if workspace is not None:
+        workspace.decoded = (A, coordinates)
+    return coordinates
+
+
+def dtw_packed(A, B, simple=True, SQUARED=True, workspace=None):
+    """ Same as classification.dtw(), but for two PackedDrawings. The
+        coordinates of A are decoded (once per workspace, see _decode()), the
+        ones of B are read directly from the array.
+        @return tuple (distance, number of evaluated cells)
+    """
+    kernel = _greedy if simple else _full
+    if A.strokes is None:
+        ((ax, ay),) = _decode(A, workspace)
+        return kernel(ax, ay, B, 0, len(B), SQUARED, workspace)
+    if len(A) != len(B):
+        return float("inf"), 0
+    distance_sum, cells = 0.0, 0
+    for stroke, (ax, ay) in enumerate(_decode(A, workspace)):
+        b = B.strokes[stroke]
+        d, c = kernel(ax, ay, B, 2 * b, B.strokes[stroke + 1] - b, SQUARED, workspace)
+        distance_sum += d
+        cells += c
+    return distance_sum, cells
+
+
+def coordinate_error(packed):
+    """ Get the largest difference of a stored coordinate of `packed` and
+        the float64 value it was created from.
+    """
+    if packed.typecode == "h":
+        return packed.step / 2
+    largest = max([abs(value) for value in packed.coords] or [0.0])
+    if largest == 0:
+        return 0.0
+    return ldexp(1.0, frexp(largest)[1] - 25)
+
+
+def error_bound(A, B, SQUARED=True):
+    """ Get the largest possible difference between the DTW distance of the
+        packed drawings A and B and the one of the unpacked float64 drawings
+        (see the module docstring).
+    """
+    e = (coordinate_error(A) + coordinate_error(B)) / 2
+    if SQUARED:
+        # D of the module docstring, from the stored values, which are at
+        # most e away from the float64 ones on average
+        xs, ys = A.points()
+        xs2, ys2 = B.points()
+        xs, ys = xs + xs2, ys + ys2
+        span = max(max(xs) - min(xs), max(ys) - min(ys)) if xs else 0.0
+        span += 2 * e
+        cell = 8 * e * span + 8 * e * e
+    else:
+        cell = 2 * sqrt(2) * e
+    if A.strokes is None:
+        return (len(A) + len(B) - 1) * cell
+    bound = 0.0
+    for stroke in range(min(len(A), len(B))):
+        n = A.strokes[stroke + 1] - A.strokes[stroke]
+        m = B.strokes[stroke + 1] - B.strokes[stroke]
+        bound += (n + m - 1) * cell
+    return bound
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
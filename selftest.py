@@ -2,66 +2,78 @@
 
 
 # Core Library modules
+import argparse
 import datetime
 import logging
 import sys
 import time
 
-# Third party modules
-import MySQLdb
-import MySQLdb.cursors
-from dbconfig import mysql
-
 # First party modules
+import dataset
+import metrics
 from classification import *
+from distance_matrix import compute_distance_matrix, copy_drawing, crossvalidate
+from packed import pack
+
+# Parameters for self-testing
+MIN_OCCURENCES = 10
+K_FOLD = 10
+EPSILON = 0
+CENTER = False
+FLATTEN = False
+THRESHOLD = 100
+SPACE_EVENLY = True
+POINTS = 100  # Does only make sense with SPACE_EVENLY=True
+QUANTIZE = None  # None, "f" or "h", see packed.py (crossvalidation_matrix only)
+
+
+def get_crossvalidation_data(rows):
+    """ Distribute the drawings of all formulas with at least MIN_OCCURENCES
+        drawings over K_FOLD folds.
+        @param  list  rows  raw drawings, see dataset.load()
+        @return tuple (folds, list of evaluated symbols, number of drawings)
+    """
+    cv, formulas = dataset.make_folds(rows, K_FOLD, MIN_OCCURENCES)
+    symbols = []
+    for formula_in_latex, count in formulas:
+        symbols.append(formula_in_latex)
+        print("%s (%i)" % (formula_in_latex, count))
+    return cv, symbols, sum(len(testset) for testset in cv)
 
 
-def crossvalidation():
-    # Parameters for self-testing
-    MIN_OCCURENCES = 10
-    K_FOLD = 10
-    EPSILON = 0
-    CENTER = False
-    FLATTEN = False
-    THRESHOLD = 100
-    SPACE_EVENLY = True
-    POINTS = 100  # Does only make sense with SPACE_EVENLY=True
+def print_report(symbols, raw_data_counter, classification_accuracy, threshold):
+    t1sum = 0
+    t10sum = 0
 
-    # Prepare crossvalidation data set
-    cv = [[], [], [], [], [], [], [], [], [], []]
+    for testset in range(K_FOLD):
+        t1sum += classification_accuracy[testset]["accuracy"]
+        t10sum += classification_accuracy[testset]["a10"]
 
-    sql = "SELECT id, formula_in_latex FROM `wm_formula`"
-    cursor.execute(sql)
-    datasets = cursor.fetchall()
+    print("\n" + "-" * 80)
+    print(str(datetime.date.today()))
+    print("The following %i symbols were evaluated:" % len(symbols))
+    print(", ".join(symbols))
+    print("raw datasets: %i" % raw_data_counter)
+    print("Epsilon: %0.2f" % EPSILON)
+    print("Center: %r" % CENTER)
+    print("Squared quadratic: False")
+    print("Flatten: %r" % FLATTEN)
+    print("Threshold: %r" % threshold)
+    print("Space evenly: %r (%i points)" % (SPACE_EVENLY, POINTS))
+    if QUANTIZE is not None:
+        print("Quantize: %r" % QUANTIZE)
+    print(
+        "* Top-1-Classification (%i-fold cross-validated): %0.5f"
+        % (K_FOLD, (t1sum / K_FOLD))
+    )
+    print(
+        "* Top-10-Classification (%i-fold cross-validated): %0.5f"
+        % (K_FOLD, t10sum / K_FOLD)
+    )
 
-    symbol_counter = 0
-    raw_data_counter = 0
-    symbols = []
 
-    for dataset in datasets:
-        sql = (
-            "SELECT id, data FROM `wm_raw_draw_data` "
-            "WHERE `accepted_formula_id` = %s" % str(dataset["id"])
-        )
-        cursor.execute(sql)
-        raw_datasets = cursor.fetchall()
-        if len(raw_datasets) >= MIN_OCCURENCES:
-            symbol_counter += 1
-            symbols.append(dataset["formula_in_latex"])
-            print("%s (%i)" % (dataset["formula_in_latex"], len(raw_datasets)))
-            i = 0
-            for raw_data in raw_datasets:
-                raw_data_counter += 1
-                cv[i].append(
-                    {
-                        "data": raw_data["data"],
-                        "id": raw_data["id"],
-                        "formula_id": dataset["id"],
-                        "accepted_formula_id": dataset["id"],
-                        "formula_in_latex": dataset["formula_in_latex"],
-                    }
-                )
-                i = (i + 1) % K_FOLD
+def crossvalidation(rows):
+    cv, symbols, raw_data_counter = get_crossvalidation_data(rows)
 
     # Start getting validation results
     classification_accuracy = []
@@ -73,32 +85,20 @@ def crossvalidation():
         for testdata in cv[testset]:
             start = time.time()
             raw_draw_data = testdata["data"]
-            if EPSILON > 0:
-                result_path = douglas_peucker(pointLineList(raw_draw_data), EPSILON)
-            else:
+            with metrics.timed("parse_query"):
                 result_path = pointLineList(raw_draw_data)
 
-            A = []
-            for line in result_path:
-                # line = space_evenly(line, 100)
-                A.append(line)
-
-            if SPACE_EVENLY:
-                Anew = []
-                for line in A:
-                    Anew.append(space_evenly(line, POINTS))
-                A = Anew
-
-            A = scale_and_center(A, CENTER)
-
-            if FLATTEN:
-                A = list_of_pointlists2pointlist(A)
+            with metrics.timed("preprocess_query"):
+                A = preprocess(
+                    result_path, EPSILON, CENTER, FLATTEN, SPACE_EVENLY, POINTS
+                )
 
             # Prepare datasets the algorithm may use
-            datasets = []
-            for key, value in enumerate(cv):
-                if key != testset:
-                    datasets += value
+            with metrics.timed("candidates"):
+                datasets = []
+                for key, value in enumerate(cv):
+                    if key != testset:
+                        datasets += value
 
             results = classify(
                 datasets, A, EPSILON, THRESHOLD, FLATTEN, SPACE_EVENLY, POINTS
@@ -154,34 +154,59 @@ def crossvalidation():
         print(sum(execution_time) / len(execution_time))
 
     print(classification_accuracy)
-
-    t1sum = 0
-    t10sum = 0
-
-    for testset in range(K_FOLD):
-        t1sum += classification_accuracy[testset]["accuracy"]
-        t10sum += classification_accuracy[testset]["a10"]
-
-    print("\n" + "-" * 80)
-    print(str(datetime.date.today()))
-    print("The following %i symbols were evaluated:" % symbol_counter)
-    print(", ".join(symbols))
-    print("raw datasets: %i" % raw_data_counter)
-    print("Epsilon: %0.2f" % EPSILON)
-    print("Center: %r" % CENTER)
-    print("Squared quadratic: False")
-    print("Flatten: %r" % FLATTEN)
-    print("Threshold: %r" % THRESHOLD)
-    print("Space evenly: %r (%i points)" % (SPACE_EVENLY, POINTS))
-    print(
-        "* Top-1-Classification (%i-fold cross-validated): %0.5f"
-        % (K_FOLD, (t1sum / K_FOLD))
-    )
-    print(
-        "* Top-10-Classification (%i-fold cross-validated): %0.5f"
-        % (K_FOLD, t10sum / K_FOLD)
-    )
+    print_report(symbols, raw_data_counter, classification_accuracy, THRESHOLD)
     print("Average time: %.5f seconds" % (sum(execution_time) / len(execution_time)))
+    for line in metrics.summary():
+        print(line)
+
+
+def crossvalidation_matrix(
+    rows, thresholds=None, processes=None, checkpoint_dir="distance-matrix"
+):
+    """ Do the same evaluation as crossvalidation(), but preprocess every
+        drawing once and derive all folds from one pairwise distance matrix.
+        The metrics are reported for each of the given thresholds.
+    """
+    if thresholds is None:
+        thresholds = [THRESHOLD]
+    cv, symbols, raw_data_counter = get_crossvalidation_data(rows)
+    items = [item for testset in cv for item in testset]
+
+    start = time.time()
+    with metrics.timed("parse_dataset"):
+        parsed = [pointLineList(item["data"]) for item in items]
+    with metrics.timed("preprocess_dataset"):
+        queries = [
+            preprocess(
+                copy_drawing(drawing), EPSILON, CENTER, FLATTEN, SPACE_EVENLY, POINTS
+            )
+            for drawing in parsed
+        ]
+        templates = None
+        if CENTER:
+            # classify() does not center the templates
+            templates = [
+                preprocess(drawing, EPSILON, False, FLATTEN, SPACE_EVENLY, POINTS)
+                for drawing in parsed
+            ]
+        if QUANTIZE is not None:
+            queries = [pack(drawing, QUANTIZE) for drawing in queries]
+            if templates is not None:
+                templates = [pack(drawing, QUANTIZE) for drawing in templates]
+    print("\n\n")
+    with metrics.timed("distance_matrix"):
+        matrix = compute_distance_matrix(
+            queries, templates, processes=processes, checkpoint_dir=checkpoint_dir
+        )
+    print("\nDistance matrix: %0.5f seconds" % (time.time() - start))
+
+    for threshold in thresholds:
+        with metrics.timed("crossvalidate"):
+            classification_accuracy = crossvalidate(matrix, cv, threshold)
+        print(classification_accuracy)
+        print_report(symbols, raw_data_counter, classification_accuracy, threshold)
+    for line in metrics.summary():
+        print(line)
 
 
 if __name__ == "__main__":
@@ -192,14 +217,28 @@ if __name__ == "__main__":
     )
 
     logging.info("Started selftest of classifier %s." % CLASSIFIER_NAME)
-    logging.info("start establishing connection")
-    connection = MySQLdb.connect(
-        host=mysql["host"],
-        user=mysql["user"],
-        passwd=mysql["passwd"],
-        db=mysql["db"],
-        cursorclass=MySQLdb.cursors.DictCursor,
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--matrix",
+        action="store_true",
+        help="derive all folds from a precomputed distance matrix",
+    )
+    parser.add_argument(
+        "--data", help="read the drawings from a JSON or SQLite file instead of MySQL"
+    )
+    parser.add_argument("--cache", help="cache the drawings from MySQL in this file")
+    parser.add_argument(
+        "--thresholds",
+        nargs="+",
+        type=float,
+        help="report the results for each of these THRESHOLD values (needs --matrix)",
     )
-    cursor = connection.cursor()
-    logging.info("end establishing connection")
-    crossvalidation()
+    args = parser.parse_args()
+    if args.thresholds and not args.matrix:
+        parser.error("--thresholds needs --matrix")
+
+    rows = dataset.load(args.data, args.cache)
+    if args.matrix:
+        crossvalidation_matrix(rows, args.thresholds)
+    else:
+        crossvalidation(rows)
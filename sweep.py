@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+"""Cross-validate a grid of preprocessing and classification parameters.
+
+The preprocessing is split into stages (simplify, resample, scale, flatten,
+pack, DTW distance matrix) which only depend on a prefix of the parameters. Every
+stage result is cached under that prefix, so configurations which only differ
+in a later parameter (for example THRESHOLD) reuse the parsed, simplified and
+resampled drawings and the distance matrix:
+
+    python sweep.py --data raw_datasets.json \\
+        --grid '{"POINTS": [10, 100], "THRESHOLD": [20, 100]}'
+"""
+
+# Core Library modules
+import argparse
+import itertools
+import json
+import logging
+import time
+from collections import OrderedDict
+
+# First party modules
+import dataset
+import metrics
+import selftest
+from classification import (
+    douglas_peucker,
+    list_of_pointlists2pointlist,
+    pointLineList,
+    scale_and_center,
+    space_evenly,
+)
+from distance_matrix import compute_distance_matrix, copy_drawing, crossvalidate
+from packed import pack
+
+# In the order of the stages which depend on them
+PARAMETERS = (
+    "EPSILON",
+    "SPACE_EVENLY",
+    "POINTS",
+    "CENTER",
+    "FLATTEN",
+    "QUANTIZE",
+    "THRESHOLD",
+)
+
+
+class StageCache:
+    """Keep the `size` most recently used results of every stage."""
+
+    def __init__(self, size=2):
+        self.size = size
+        self._stages = {}
+
+    def get(self, stage, key, compute):
+        entries = self._stages.setdefault(stage, OrderedDict())
+        hit = key in entries
+        metrics.record_cache("sweep_" + stage, hit)
+        if hit:
+            entries.move_to_end(key)
+            return entries[key]
+        with metrics.timed(stage):
+            entries[key] = compute()
+        if len(entries) > self.size:
+            entries.popitem(last=False)
+        return entries[key]
+
+
+def expand_grid(grid):
+    """Get all configurations of the grid, ordered such that configurations
+        with a common prefix of PARAMETERS follow each other. Parameters which
+        are not in the grid get the value of selftest.py.
+
+    >>> configs = expand_grid({'THRESHOLD': [20, 100], 'SPACE_EVENLY': [False],
+    ...                        'POINTS': [10, 100]})
+    >>> [(c['POINTS'], c['THRESHOLD']) for c in configs]
+    [(None, 20), (None, 100)]
+    """
+    values = []
+    for name in PARAMETERS:
+        values.append(grid.get(name, [getattr(selftest, name)]))
+    configs = []
+    for combination in itertools.product(*values):
+        config = dict(zip(PARAMETERS, combination))
+        # Normalize parameters which do not have an effect
+        if config["EPSILON"] <= 0:
+            config["EPSILON"] = 0
+        if not config["SPACE_EVENLY"]:
+            config["POINTS"] = None
+        if config not in configs:
+            configs.append(config)
+    return configs
+
+
+class Sweep:
+    """Cross-validation of several configurations on the same drawings."""
+
+    def __init__(self, rows, processes=None, checkpoint_dir=None, cache_size=2):
+        self.cv, self.symbols, self.raw_data_counter = (
+            selftest.get_crossvalidation_data(rows)
+        )
+        items = [item for testset in self.cv for item in testset]
+        with metrics.timed("parse_dataset"):
+            self.parsed = [pointLineList(item["data"]) for item in items]
+        self.processes = processes
+        self.checkpoint_dir = checkpoint_dir
+        self.cache = StageCache(cache_size)
+
+    def drawings(self, config, center):
+        """Get the drawings preprocessed as given by `config`."""
+        epsilon, points = config["EPSILON"], config["POINTS"]
+        simplified = self.cache.get(
+            "simplify",
+            (epsilon,),
+            lambda: [
+                (
+                    douglas_peucker(copy_drawing(drawing), epsilon)
+                    if epsilon > 0
+                    else drawing
+                )
+                for drawing in self.parsed
+            ],
+        )
+        resampled = self.cache.get(
+            "resample",
+            (epsilon, points),
+            lambda: [
+                (
+                    [space_evenly(line, points) for line in drawing]
+                    if points is not None
+                    else drawing
+                )
+                for drawing in simplified
+            ],
+        )
+        scaled = self.cache.get(
+            "scale",
+            (epsilon, points, center),
+            lambda: [
+                scale_and_center(copy_drawing(drawing), center) for drawing in resampled
+            ],
+        )
+        flattened = scaled
+        if config["FLATTEN"]:
+            flattened = self.cache.get(
+                "flatten",
+                (epsilon, points, center),
+                lambda: [list_of_pointlists2pointlist(drawing) for drawing in scaled],
+            )
+        quantize = config["QUANTIZE"]
+        if quantize is None:
+            return flattened
+        return self.cache.get(
+            "pack",
+            (epsilon, points, center, config["FLATTEN"], quantize),
+            lambda: [pack(drawing, quantize) for drawing in flattened],
+        )
+
+    def distance_matrix(self, config):
+        key = tuple(config[name] for name in PARAMETERS if name != "THRESHOLD")
+
+        def compute():
+            queries = self.drawings(config, config["CENTER"])
+            templates = None
+            if config["CENTER"]:
+                # classify() does not center the templates
+                templates = self.drawings(config, False)
+            return compute_distance_matrix(
+                queries,
+                templates,
+                processes=self.processes,
+                checkpoint_dir=self.checkpoint_dir,
+            )
+
+        return self.cache.get("distance_matrix", key, compute)
+
+    def run(self, config):
+        """Cross-validate one configuration.
+        @return dict with the configuration, the top-1 and top-10 accuracy
+                and the time it took
+        """
+        start = time.time()
+        matrix = self.distance_matrix(config)
+        with metrics.timed("crossvalidate"):
+            classification_accuracy = crossvalidate(
+                matrix, self.cv, config["THRESHOLD"]
+            )
+        result = dict(config)
+        folds = len(classification_accuracy)
+        result["top1"] = sum(a["accuracy"] for a in classification_accuracy) / folds
+        result["top10"] = sum(a["a10"] for a in classification_accuracy) / folds
+        result["seconds"] = time.time() - start
+        return result
+
+
+def format_table(results):
+    """Format the results of several runs as a Markdown table."""
+    columns = PARAMETERS + ("top1", "top10", "seconds")
+    lines = [
+        "| " + " | ".join(columns) + " |",
+        "|" + "|".join("---" for _ in columns) + "|",
+    ]
+    for result in results:
+        cells = []
+        for column in columns:
+            value = result[column]
+            cells.append("%0.5f" % value if isinstance(value, float) else str(value))
+        lines.append("| " + " | ".join(cells) + " |")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--grid",
+        default="{}",
+        help="JSON object mapping parameters (%s) to lists of values"
+        % ", ".join(PARAMETERS),
+    )
+    parser.add_argument(
+        "--data", help="read the drawings from a JSON or SQLite file instead of MySQL"
+    )
+    parser.add_argument("--cache", help="cache the drawings from MySQL in this file")
+    parser.add_argument("--processes", type=int, help="worker processes for DTW")
+    parser.add_argument(
+        "--checkpoint-dir",
+        default="distance-matrix",
+        help="directory for checkpoints of the distance matrices",
+    )
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    grid = json.loads(args.grid)
+    unknown = set(grid) - set(PARAMETERS)
+    if unknown:
+        parser.error("Unknown parameters: %s" % ", ".join(sorted(unknown)))
+
+    rows = dataset.load(args.data, args.cache)
+    sweep = Sweep(rows, args.processes, args.checkpoint_dir)
+    results = []
+    for config in expand_grid(grid):
+        logging.info("Evaluate %s", config)
+        results.append(sweep.run(config))
+
+    print("\n")
+    print(format_table(results))
+    for line in metrics.summary():
+        print(line)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        filename="sweep.log",
+        level=logging.DEBUG,
+        format="%(asctime)s %(levelname)s: %(message)s",
+    )
+    main()